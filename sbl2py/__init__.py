@@ -27,6 +27,8 @@
 A Snowball to Python compiler.
 """
 
+import os
+
 import sbl2py.ast
 import sbl2py.grammar
 
@@ -34,6 +36,13 @@ import sbl2py.grammar
 __version__ = '0.1.0-2'
 
 
+# Results of ``translate_string``, keyed by its arguments. The cache is
+# only used if the environment variable ``SBL2PY_CACHE`` is set to ``1``.
+_translation_cache = {}
+_translation_cache_size = 64
+_use_translation_cache = os.environ.get('SBL2PY_CACHE', '0') == '1'
+
+
 def translate_file(infile, *args, **kwargs):
     """
     Translate a Snowball file to Python.
@@ -58,8 +67,33 @@ def translate_string(code, header=None, debug=False):
     both the original ``_String`` object and the ``_Program`` instance
     that created it. This is useful for checking that variables have
     been computed correctly.
+
+    If the environment variable ``SBL2PY_CACHE`` is set to ``1`` then
+    translations are cached: translating the same code with the same
+    options again returns the previous result (including its creation
+    date). Use ``clear_cache`` to discard cached translations.
     """
-    node = sbl2py.grammar.parse_string(code)
+    if _use_translation_cache:
+        key = (code, header, debug)
+        try:
+            return _translation_cache[key]
+        except KeyError:
+            pass
+    if code.strip():
+        node = sbl2py.grammar.parse_string(code)
+    else:
+        node = sbl2py.ast.ProgramNode()
     env = sbl2py.ast.Environment(header=header, debug=debug)
-    return node.generate_code(env)
+    py_code = node.generate_code(env)
+    if _use_translation_cache:
+        if len(_translation_cache) >= _translation_cache_size:
+            _translation_cache.clear()
+        _translation_cache[key] = py_code
+    return py_code
+
+def clear_cache():
+    """
+    Clear the cache of ``translate_string``.
+    """
+    _translation_cache.clear()
 
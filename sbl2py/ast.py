@@ -27,7 +27,6 @@
 Abstract syntax tree (AST) and code generation for sbl2py.
 """
 
-import collections
 import datetime
 import re
 
@@ -35,6 +34,48 @@ import sbl2py
 import sbl2py.utils
 
 
+# Placeholders in pseudo code, see ``Environment.transform_pseudo_code``
+_var_re = re.compile(r"<v\d*>")
+_token_re = re.compile(r"( *)<t(\d+)>")
+
+# Results of ``_compile_pseudo_code``, keyed by the pseudo code
+_template_cache = {}
+_template_cache_size = 256
+
+
+def _compile_pseudo_code(code):
+    """
+    Compile pseudo code into a template for ``%``-formatting.
+
+    Empty lines are removed and the placeholders are replaced by
+    mapping keys. Returns a tuple ``(template, variables, tokens)``:
+    ``variables`` is a list of the ``<v\d*>`` placeholders (the mapping
+    key is the placeholder without the angle brackets) and ``tokens``
+    is a list of ``(key, index, indentation)`` tuples, one for each
+    distinct ``<t\d+>`` placeholder and indentation.
+
+    If there are no placeholders then the template is the cleaned code
+    itself and must not be formatted.
+    """
+    code = sbl2py.utils.remove_empty_lines(code)
+    variables = list(set(_var_re.findall(code))) if '<v' in code else []
+    if not variables and '<t' not in code:
+        return code, [], []
+    template = code.replace('%', '%%')
+    for var in variables:
+        template = template.replace(var, '%%(%s)s' % var[1:-1])
+    tokens = []
+
+    def sub(match):
+        key = 't%s_%d' % (match.group(2), len(match.group(1)))
+        if key not in [token[0] for token in tokens]:
+            tokens.append((key, int(match.group(2)), match.group(1)))
+        return '%%(%s)s' % key
+
+    template = _token_re.sub(sub, template)
+    return template, variables, tokens
+
+
 class Environment(object):
     """
     Code generation environment.
@@ -57,10 +98,13 @@ class Environment(object):
         self.header = header
         self.direction = 1
         self.module_code = []
-        self.class_code = []
+        self.routine_code = []
+        self.inline_routines = {}
         self.init_code = []
         self.among_index = 0
+        self.among_tables = {}
         self.var_index = 0
+        self.code_cache = {}
 
     def claim_among_index(self):
         self.among_index += 1
@@ -82,24 +126,43 @@ class Environment(object):
           corresponding item in the ``tokens`` list. Indentation is
           preserved, even among multiple lines.
         """
-        code = sbl2py.utils.remove_empty_lines(code)
-        tokens = sbl2py.utils.extract_strings(tokens)
-        for v in set(re.findall(r"<v\d*>", code)):
-            unique = "var%d" % self.var_index
+        # The placeholders are located only once per pseudo code string,
+        # afterwards all of them are replaced in a single formatting step.
+        try:
+            template, variables, token_keys = _template_cache[code]
+        except KeyError:
+            if len(_template_cache) >= _template_cache_size:
+                _template_cache.clear()
+            compiled = _compile_pseudo_code(code)
+            _template_cache[code] = compiled
+            template, variables, token_keys = compiled
+        if not (variables or token_keys):
+            return template  # No placeholders, e.g. ``r = True``
+
+        values = {}
+        for var in variables:
+            values[var[1:-1]] = "var%d" % self.var_index
             self.var_index += 1
-            code = code.replace(v, unique)
-
-        def sub(match):
-            return sbl2py.utils.prefix_lines(
-                    tokens[int(match.group(2))], match.group(1))
-
-        return re.sub(r"( *)<t(\d+)>", sub, code)
+        if token_keys:
+            tokens = sbl2py.utils.extract_strings(tokens)
+            for key, index, indentation in token_keys:
+                token = tokens[index]
+                # Most tokens are single-line expressions without
+                # indentation (e.g. ``r = s_insert(<t0>)``)
+                if indentation:
+                    if '\n' in token:
+                        token = sbl2py.utils.prefix_lines(token, indentation)
+                    else:
+                        token = indentation + token
+                values[key] = token
+        return template % values
 
 # Ideally we would like ``Node`` to be simply a subclass of ``list``.
 # However, pyparsing does some automagic to results that are instances
 # of ``list``. Since we don't want that we re-implement the desired
-# functionality without subclassing ``list``.
-class Node(collections.MutableSequence):
+# functionality without subclassing ``list``. The generic implementations
+# of ``collections.MutableSequence`` are not used since they are slow.
+class Node(object):
     """
     Base class for nodes in the AST.
 
@@ -110,20 +173,34 @@ class Node(collections.MutableSequence):
     """
     label = ''
 
+    # Whether the code of this node may be reused for structurally
+    # identical nodes, see ``cache_key``.
+    cacheable = True
+
     def __init__(self):
         self.children = []
         self.parent = None
+        self.parent_index = None  # Index in ``parent.children``
 
     def __getitem__(self, index):
         return self.children[index]
 
+    def __iter__(self):
+        return iter(self.children)
+
     def __setitem__(self, index, value):
+        if index < 0:
+            index += len(self.children)
         self.children[index] = value
         value.parent = self
+        value.parent_index = index
 
     def __delitem__(self, index):
+        if index < 0:
+            index += len(self.children)
         self.children[index].parent = None
         del self.children[index]
+        self._update_parent_indices(index)
 
     def __len__(self):
         return len(self.children)
@@ -131,6 +208,26 @@ class Node(collections.MutableSequence):
     def insert(self, index, value):
         self.children.insert(index, value)
         value.parent = self
+        if index < 0:
+            index = 0
+        self._update_parent_indices(min(index, len(self.children) - 1))
+
+    def append(self, value):
+        value.parent = self
+        value.parent_index = len(self.children)
+        self.children.append(value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def _update_parent_indices(self, start):
+        """
+        Update ``parent_index`` of the children from ``start`` on.
+        """
+        children = self.children
+        for index in xrange(start, len(children)):
+            children[index].parent_index = index
 
     def generate_children_codes(self, env):
         """
@@ -139,8 +236,40 @@ class Node(collections.MutableSequence):
         ``env`` is an instance of ``Environment``.
 
         Returns the code blocks generated by the children as a list.
+
+        Code for structurally identical children is only generated once.
+        """
+        codes = []
+        for node in self:
+            key = node.cache_key()
+            if key is None:
+                codes.append(node.generate_code(env))
+                continue
+            key = (env.direction, key)
+            try:
+                code = env.code_cache[key]
+            except KeyError:
+                code = env.code_cache[key] = node.generate_code(env)
+            codes.append(code)
+        return codes
+
+    def cache_key(self):
         """
-        return [node.generate_code(env) for node in self]
+        Return a hashable key for the generated code of this node.
+
+        Nodes with the same key generate the same code. ``None`` is
+        returned if the node's code must be generated each time, e.g.
+        because code generation has side effects on the environment.
+        """
+        if not self.cacheable:
+            return None
+        keys = [self.__class__]
+        for child in self:
+            key = child.cache_key()
+            if key is None:
+                return None
+            keys.append(key)
+        return tuple(keys)
 
     def generate_code(self, env):
         """
@@ -154,9 +283,8 @@ class Node(collections.MutableSequence):
         """
         Return next sibling node in AST.
         """
-        siblings = self.parent.children
         try:
-            return siblings[siblings.index(self) + 1]
+            return self.parent.children[self.parent_index + 1]
         except IndexError:
             raise ValueError('Node has no next sibling.')
 
@@ -360,7 +488,9 @@ r = True
 class LoopNode(_PseudoCodeNode):
     label = 'loop'
     code = """
-for <v> in xrange(<t0>):
+<v> = <t0>
+while <v> > 0:
+    <v> -= 1
     <t1>
     if not r:
         break
@@ -369,7 +499,9 @@ for <v> in xrange(<t0>):
 class AtLeastNode(_PseudoCodeNode):
     label = 'atleast'
     code = """
-for <v> in xrange(<t0>):
+<v> = <t0>
+while <v> > 0:
+    <v> -= 1
     <t1>
     if not r:
         break
@@ -383,7 +515,9 @@ if r:
     r = True
 """
     backwards_code = """
-for <v> in xrange(<t0>):
+<v> = <t0>
+while <v> > 0:
+    <v> -= 1
     <t1>
     if not r:
         break
@@ -416,47 +550,110 @@ s.limit = len(s) - <v1>
         env.direction *= -1
         return code
 
-def _generate_substring_code(env, index):
-    code = """
-a_%d = None
+_SUBSTRING_CODE = """
+a_%(index)d = None
 r = False
 <v4> = s.cursor
-for <v0>, <v1>, <v2> in _a_%d:
-    if s.starts_with(<v0>):
-        <v3> = s.cursor
-        r = (not <v1>) or getattr(self, <v1>)(s)
-        if r:
-          s.cursor = <v3>
-          a_%d = <v2>
-          break
+<v5> = %(table)s
+<v7> = <v4>
+while <v7> != s.limit:
+    <v6> = <v5>.get(s.chars[<v7>])
+    if <v6> is None:
+        break
+    <v5> = <v6>
+    <v7> += 1
+for <v0>, <v1>, <v2> in <v5>[None]:
+    <v3> = <v4> + len(<v0>)
+    s.cursor = <v3>
+    r = <v1> is None or <v1>(self, s)
+    if r:
+        s.cursor = <v3>
+        a_%(index)d = <v2>
+        break
     s.cursor = <v4>
-""" % (index, index, index)
+"""
+
+_SUBSTRING_BACKWARDS_CODE = """
+a_%(index)d = None
+r = False
+<v4> = s.cursor
+<v5> = %(table)s
+<v7> = <v4>
+while <v7> != s.limit:
+    <v6> = <v5>.get(s.chars[<v7> - 1])
+    if <v6> is None:
+        break
+    <v5> = <v6>
+    <v7> -= 1
+for <v0>, <v1>, <v2> in <v5>[None]:
+    <v3> = <v4> - len(<v0>)
+    s.cursor = <v3>
+    r = <v1> is None or <v1>(self, s)
+    if r:
+        s.cursor = <v3>
+        a_%(index)d = <v2>
+        break
+    s.cursor = <v4>
+"""
+
+def _generate_substring_code(env, among):
+    # The among strings are stored in a trie (see
+    # ``AmongNode.generate_var``). The trie is walked as far as the
+    # string allows, the node reached lists all matching candidates.
+    if env.direction == 1:
+        code = _SUBSTRING_CODE
+    else:
+        code = _SUBSTRING_BACKWARDS_CODE
+    code = code % {'index':among.among_index, 'table':among.claim_table(env)}
     return env.transform_pseudo_code(code, [])
 
+def _format_among_trie(node, candidates=()):
+    """
+    Format an among trie as Python code.
+
+    ``candidates`` are the candidates of the node's ancestors, they are
+    appended to the node's own candidates so that each node lists all
+    candidates that match when the trie walk stops there. Candidates
+    are given as code strings.
+    """
+    candidates = tuple(node[None]) + candidates
+    if candidates:
+        items = ['None: (' + ', '.join(candidates) + ',)']
+    else:
+        items = ['None: ()']
+    for char in sorted(key for key in node if key is not None):
+        items.append('%r: %s' % (char,
+                                 _format_among_trie(node[char], candidates)))
+    return '{' + ', '.join(items) + '}'
+
 def _make_if_chain(blocks):
     """
     Chain code blocks together, check if ``r`` is true between them.
+
+    The checks are not nested: once a block has set ``r`` to false all
+    following checks fail, too.
     """
     code = [blocks[0]]
-    prefix = ''
     for block in blocks[1:]:
-        code.append(prefix + 'if r:')
-        prefix += '    '
-        code.append(sbl2py.utils.prefix_lines(block, prefix))
+        code.append('if r:')
+        code.append(sbl2py.utils.prefix_lines(block, '    '))
     return '\n'.join(code)
 
 class SubstringNode(Node):
     label = 'substring'
+    cacheable = False
+
     def generate_code(self, env):
         among_index = env.claim_among_index()
         current = self.next()
         while not isinstance(current, AmongNode):
             current = current.next()
         current.among_index = among_index
-        return self.annotate(_generate_substring_code(env, among_index))
+        return self.annotate(_generate_substring_code(env, current))
 
 class AmongNode(Node):
     label = 'among'
+    cacheable = False
 
     def __init__(self, strings, commands, common_cmd=None):
         """
@@ -481,12 +678,40 @@ class AmongNode(Node):
         self.commands = commands
         self.common_cmd = common_cmd
 
-    def generate_var(self):
-        code = []
-        for s in self.strings:
-            routine = 'r_' + s[1] if s[1] else ''
-            code.append("(%r, '%s', %d)" % (s[0], routine, s[2]))
-        return '_a_%d = (' % self.among_index + ', '.join(code) + ',)'
+    def generate_var(self, direction):
+        """
+        Generate the module-level trie of the among strings.
+
+        Each trie node is a dict that maps the next character (going in
+        ``direction``) to a child node. Under the key ``None`` a node
+        stores the candidates whose strings match if the trie walk
+        stops at that node, longest first. Each candidate is a tuple of
+        the string, its routine function (or ``None``) and its command
+        index.
+        """
+        root = {None: []}
+        for string, routine, index in self.strings:
+            node = root
+            for char in (string if direction == 1 else string[::-1]):
+                node = node.setdefault(char, {None: []})
+            routine = '_r_' + routine if routine else 'None'
+            node[None].append('(%r, %s, %d)' % (string, routine, index))
+        return '_a_%d = %s' % (self.among_index, _format_among_trie(root))
+
+    def claim_table(self, env):
+        """
+        Return the name of the module-level table of this among.
+
+        The table is generated on the first call. Amongs with the same
+        strings share a single table.
+        """
+        key = (tuple(self.strings), env.direction)
+        try:
+            return env.among_tables[key]
+        except KeyError:
+            name = env.among_tables[key] = '_a_%d' % self.among_index
+            env.module_code.append(self.generate_var(env.direction))
+            return name
 
     def generate_if_chain(self, env):
         code = []
@@ -504,8 +729,7 @@ class AmongNode(Node):
         blocks = []
         if self.among_index is None:
             self.among_index = env.claim_among_index()
-            blocks.append(_generate_substring_code(env, self.among_index))
-        env.module_code.append(self.generate_var())
+            blocks.append(_generate_substring_code(env, self))
         if self.common_cmd:
             blocks.append(self.common_cmd.generate_code(env))
         blocks.append(self.generate_if_chain(env))
@@ -522,37 +746,37 @@ class AmongNode(Node):
 class InsertNode(_PseudoCodeNode):
     label = 'insert'
     code = """
-r = s.insert(<t0>)
+r = s_insert(<t0>)
 """
 
 class AttachNode(_PseudoCodeNode):
     label = 'attach'
     code = """
-r = s.attach(<t0>)
+r = s_attach(<t0>)
 """
 
 class ReplaceSliceNode(_PseudoCodeNode):
     label = '<-'
     code = """
-r = s.set_range(self.left, self.right, <t0>)
+r = s_set_range(self.left, self.right, <t0>)
 """
 
 class ExportSliceNode(_PseudoCodeNode):
     label = '->'
     code = """
-r = <t0>.set_chars(s.get_range(self.left, self.right))
+r = <t0>.set_chars(s_get_range(self.left, self.right))
 """
 
 class HopNode(_PseudoCodeNode):
     label = 'hop'
     code = """
-r = s.hop(<t0>)
+r = s_hop(<t0>)
 """
 
 class NextNode(_PseudoCodeNode):
     label = 'next'
     code = """
-r = s.hop(1)
+r = s_hop(1)
 """
 
 class SetLeftNode(_PseudoCodeNode):
@@ -579,7 +803,7 @@ r = True
 class ToMarkNode(_PseudoCodeNode):
     label = 'tomark'
     code = """
-r = s.to_mark(<t0>)
+r = s_to_mark(<t0>)
 """
 
 class AtMarkNode(_PseudoCodeNode):
@@ -610,45 +834,37 @@ pass
 class GroupingNode(_PseudoCodeNode):
     label = 'grouping check'
     code = """
-if s.cursor == s.limit:
-    r = False
-else:
-    r = s.chars[s.cursor] in <t0>
+<v> = s.cursor
+r = <v> != s.limit and s.chars[<v>] in <t0>
 if r:
-    s.cursor += 1
+    s.cursor = <v> + 1
 """
     backwards_code = """
-if s.cursor == s.limit:
-    r = False
-else:
-    r = s.chars[s.cursor - 1] in <t0>
+<v> = s.cursor
+r = <v> != s.limit and s.chars[<v> - 1] in <t0>
 if r:
-    s.cursor -= 1
+    s.cursor = <v> - 1
 """
 
 class NonNode(_PseudoCodeNode):
     label = 'negative grouping check'
     code = """
-if s.cursor == s.limit:
-    r = False
-else:
-    r = s.chars[s.cursor] not in <t0>
+<v> = s.cursor
+r = <v> != s.limit and s.chars[<v>] not in <t0>
 if r:
-    s.cursor += 1
+    s.cursor = <v> + 1
 """
     backwards_code = """
-if s.cursor == s.limit:
-    r = False
-else:
-    r = s.chars[s.cursor - 1] not in <t0>
+<v> = s.cursor
+r = <v> != s.limit and s.chars[<v> - 1] not in <t0>
 if r:
-    s.cursor -= 1
+    s.cursor = <v> - 1
 """
 
 class DeleteNode(_PseudoCodeNode):
     label = 'delete'
     code = """
-r = s.set_range(self.left, self.right, u'')
+r = s_set_range(self.left, self.right, u'')
 """
 
 class AtLimitNode(_PseudoCodeNode):
@@ -667,15 +883,65 @@ r = True
 class StartsWithNode(_PseudoCodeNode):
     label = 'character check'
     code = """
-r = s.starts_with(<t0>)
+r = s_starts_with(<t0>)
+"""
+
+    # Literals are checked inline since their length is known
+    char_code = """
+<v> = s.cursor
+r = <v> != s.limit and s.chars[<v>] == <t0>
+if r:
+    s.cursor = <v> + 1
+"""
+    backwards_char_code = """
+<v> = s.cursor
+r = <v> != s.limit and s.chars[<v> - 1] == <t0>
+if r:
+    s.cursor = <v> - 1
+"""
+    literal_code = """
+r = s.chars.startswith(<t0>, s.cursor, s.limit)
+if r:
+    s.cursor += %d
+"""
+    backwards_literal_code = """
+r = s.chars.endswith(<t0>, s.limit, s.cursor)
+if r:
+    s.cursor -= %d
 """
 
+    def generate_code(self, env):
+        if not isinstance(self[0], StringLiteralNode) or not self[0].string:
+            return super(StartsWithNode, self).generate_code(env)
+        n = len(self[0].string)
+        if n == 1:
+            if env.direction == 1:
+                code = self.char_code
+            else:
+                code = self.backwards_char_code
+        else:
+            if env.direction == 1:
+                code = self.literal_code % n
+            else:
+                code = self.backwards_literal_code % n
+        code = env.transform_pseudo_code(code,
+                self.generate_children_codes(env))
+        return self.annotate(code)
+
 class RoutineCallNode(_PseudoCodeNode):
     label = 'routine call'
     code = """
-r = <t0>(s)
+r = <t0>(self, s)
 """
 
+    def generate_code(self, env):
+        definition = env.inline_routines.get(self[0].name)
+        if definition is None:
+            return super(RoutineCallNode, self).generate_code(env)
+        # The routine's body replaces the call, see
+        # ``_find_inline_routines``.
+        return self.annotate('r = True\n' + definition[0].generate_code(env))
+
 class TrueCommandNode(_PseudoCodeNode):
     label = 'true'
     code = """
@@ -718,24 +984,44 @@ if r:
 """
 
 class BackwardModeNode(Node):
+    cacheable = False
+
     def generate_code(self, env):
         env.direction *= -1
         self.generate_children_codes(env)
         env.direction *= -1
         return ''
 
+# ``_String`` methods that routines bind to local ``s_<method>`` names
+_STRING_METHODS = ['starts_with', 'hop', 'insert', 'attach', 'set_range',
+                   'get_range', 'to_mark']
+
 class RoutineDefinitionNode(Node):
+    cacheable = False
 
     def __init__(self, name):
         super(RoutineDefinitionNode, self).__init__()
         self.name = name
 
     def generate_code(self, env):
-        code = ['def r_%s(self, s):' % self.name, '    r = True']
-        code.append(
-                sbl2py.utils.prefix_lines(self[0].generate_code(env), '    '))
+        if self.name in env.inline_routines:
+            return ''  # Code is generated at the call site
+        command = self[0]
+        if isinstance(command, ConcatenationNode):
+            # Leave the routine as soon as one of the commands fails
+            # instead of checking ``r`` before each remaining command.
+            body = '\nif not r:\n    return False\n'.join(
+                    command.generate_children_codes(env))
+        else:
+            body = command.generate_code(env)
+        code = ['def _r_%s(self, s, len=len):' % self.name, '    r = True']
+        # The pseudo code calls the methods of ``s`` via local names
+        for method in _STRING_METHODS:
+            if ('s_%s(' % method) in body:
+                code.append('    s_%s = s.%s' % (method, method))
+        code.append(sbl2py.utils.prefix_lines(body, '    '))
         code.append('    return r')
-        env.class_code.append('\n'.join(code))
+        env.routine_code.append('\n'.join(code))
         return ''
 
 class CharSetNode(Node):
@@ -744,8 +1030,11 @@ class CharSetNode(Node):
         super(CharSetNode, self).__init__()
         self.chars = chars
 
+    def cache_key(self):
+        return (self.__class__, self.chars)
+
     def generate_code(self, env):
-        return "set(%s)" % repr(self.chars)
+        return "frozenset(%s)" % repr(self.chars)
 
 class SetUnionNode(_PseudoCodeNode):
     code = '(<t0> | <t1>)'
@@ -754,6 +1043,8 @@ class SetDifferenceNode(_PseudoCodeNode):
     code = '(<t0> - <t1>)'
 
 class GroupingDefinitionNode(Node):
+    cacheable = False
+
     def __init__(self, name):
         super(GroupingDefinitionNode, self).__init__()
         self.name = name
@@ -770,20 +1061,18 @@ class ConcatenationNode(Node):
 class _IfChainNode(Node):
     not_str = ''
     def generate_code(self, env):
+        # The checks are not nested, see ``_make_if_chain``.
         if env.direction == 1:
-            lines = ['<v> = s.cursor']
+            lines = ['<v> = s.cursor', '<t0>']
+            restore = '    s.cursor = <v>'
         else:
-            lines = ['<v> = len(s) - s.cursor']
-        lines.append('<t0>')
-        prefix = ''
+            lines = ['<v> = len(s) - s.cursor', '<t0>']
+            restore = '    s.cursor = len(s) - <v>'
+        check = 'if ' + self.not_str + 'r:'
         for t in range(1, len(self)):
-            lines.append(prefix + 'if ' + self.not_str +'r:')
-            prefix += '    '
-            if env.direction == 1:
-                lines.append(prefix + 's.cursor = <v>')
-            else:
-                lines.append(prefix + 's.cursor = len(s) - <v>')
-            lines.append(prefix + '<t%d>' % t)
+            lines.append(check)
+            lines.append(restore)
+            lines.append('    <t%d>' % t)
         code = '\n'.join(lines)
         code = env.transform_pseudo_code(code,
                 self.generate_children_codes(env))
@@ -804,6 +1093,9 @@ class _ReferenceNode(Node):
         super(_ReferenceNode, self).__init__()
         self.name = name
 
+    def cache_key(self):
+        return (self.__class__, self.name)
+
     def generate_code(self, env):
         return self.prefix + self.name + self.suffix
 
@@ -821,7 +1113,7 @@ class BooleanReferenceNode(_ReferenceNode):
     prefix = 'self.b_'
 
 class RoutineReferenceNode(_ReferenceNode):
-    prefix = 'self.r_'
+    prefix = '_r_'
 
 class GroupingReferenceNode(_ReferenceNode):
     prefix = '_g_'
@@ -831,21 +1123,29 @@ class StringLiteralNode(Node):
     def __init__(self, string):
         super(StringLiteralNode, self).__init__()
         self.string = string
+        code = repr(string)
+        if not code.startswith('u'):
+            code = 'u' + code
+        self.code = code
+
+    def cache_key(self):
+        return (self.__class__, self.string)
 
     def generate_code(self, env):
-        c = repr(self.string)
-        if not c.startswith('u'):
-            c = 'u' + c
-        return c
+        return self.code
 
 class IntegerLiteralNode(Node):
 
     def __init__(self, integer):
         super(IntegerLiteralNode, self).__init__()
         self.integer = integer
+        self.code = str(integer)
+
+    def cache_key(self):
+        return (self.__class__, self.integer)
 
     def generate_code(self, env):
-        return str(self.integer)
+        return self.code
 
 class MaxIntNode(_PseudoCodeNode):
     code = 'sys.maxint'
@@ -867,14 +1167,12 @@ class SizeOfNode(_PseudoCodeNode):
 
 class _ArithmeticOperationNode(Node):
     operator = ''
-    use_brackets = False
 
     def generate_code(self, env):
+        # Always use brackets, operands may be operations themselves
+        # (e.g. ``8 / (4 / 2)``).
         delim = ' ' + self.operator + ' '
-        code = delim.join(self.generate_children_codes(env))
-        if self.use_brackets:
-            code = '(' + code + ')'
-        return code
+        return '(' + delim.join(self.generate_children_codes(env)) + ')'
 
 class MultiplicationNode(_ArithmeticOperationNode):
     operator = '*'
@@ -884,11 +1182,9 @@ class DivisionNode(_ArithmeticOperationNode):
 
 class AdditionNode(_ArithmeticOperationNode):
     operator = '+'
-    use_brackets = True
 
 class SubtractionNode(_ArithmeticOperationNode):
     operator = '-'
-    use_brackets = True
 
 class NegationNode(_PseudoCodeNode):
     code = '(-<t0>)'
@@ -964,6 +1260,8 @@ r = <t0> <= <t1>
 """
 
 class _InitDeclarationNode(Node):
+    cacheable = False
+
     def __init__(self, name):
         super(_InitDeclarationNode, self).__init__()
         self.name = name
@@ -987,7 +1285,7 @@ class BooleanDeclarationNode(_InitDeclarationNode):
 _FUNC_TEMPLATE = """
 def %s(s):
     s = _String(s)
-    _Program().r_%s(s)
+    _r_%s(_Program(), s)
     return unicode(s)
 """
 
@@ -995,11 +1293,13 @@ _DEBUG_FUNC_TEMPLATE = """
 def %s(s):
     p = _Program()
     s = _String(s)
-    p.r_%s(s)
+    _r_%s(p, s)
     return s, p
 """
 
 class ExternalDeclarationNode(Node):
+    cacheable = False
+
     def __init__(self, name):
         super(ExternalDeclarationNode, self).__init__()
         self.name = name
@@ -1010,6 +1310,8 @@ class ExternalDeclarationNode(Node):
         return ''
 
 class _NoOpDeclarationNode(Node):
+    cacheable = False
+
     def __init__(self, name):
         super(_NoOpDeclarationNode, self).__init__()
         self.name = ''
@@ -1036,13 +1338,13 @@ import sys
 class _String(object):
 
     def __init__(self, s):
-        self.chars = list(unicode(s))
+        self.chars = unicode(s)
         self.cursor = 0
         self.limit = len(s)
         self.direction = 1
 
     def __unicode__(self):
-        return u''.join(self.chars)
+        return self.chars
 
     def __len__(self):
         return len(self.chars)
@@ -1051,14 +1353,13 @@ class _String(object):
         if self.direction == 1:
             return self.chars[start:stop]
         else:
-            n = len(self.chars)
             return self.chars[stop:start]
 
     def set_range(self, start, stop, chars):
         if self.direction == 1:
-            self.chars[start:stop] = chars
+            self.chars = self.chars[:start] + chars + self.chars[stop:]
         else:
-            self.chars[stop:start] = chars
+            self.chars = self.chars[:stop] + chars + self.chars[start:]
         change = self.direction * (len(chars) - (stop - start))
         if self.direction == 1:
             if self.cursor >= stop:
@@ -1072,14 +1373,16 @@ class _String(object):
         return True
 
     def insert(self, chars):
-        self.chars[self.cursor:self.cursor] = chars
+        self.chars = (self.chars[:self.cursor] + chars +
+                      self.chars[self.cursor:])
         if self.direction == 1:
             self.cursor += len(chars)
             self.limit += len(chars)
         return True
 
     def attach(self, chars):
-        self.chars[self.cursor:self.cursor] = chars
+        self.chars = (self.chars[:self.cursor] + chars +
+                      self.chars[self.cursor:])
         if self.direction == 1:
             self.limit += len(chars)
         else:
@@ -1097,11 +1400,13 @@ class _String(object):
         return True
 
     def starts_with(self, chars):
-        n = len(chars)
-        r = self.get_range(self.cursor, self.limit)[::self.direction][:n]
-        if not r == list(chars)[::self.direction]:
-            return False
-        self.cursor += n * self.direction
+        if self.direction == 1:
+            if not self.chars.startswith(chars, self.cursor, self.limit):
+                return False
+        else:
+            if not self.chars.endswith(chars, self.limit, self.cursor):
+                return False
+        self.cursor += len(chars) * self.direction
         return True
 
     def hop(self, n):
@@ -1120,22 +1425,97 @@ class _String(object):
         self.cursor = mark
         return True
 
-%(module_code)s
-
 class _Program(object):
     def __init__(self):
         self.left = None
         self.right = None
 %(init_code)s
 
-%(class_code)s
+%(routine_code)s
+
+%(module_code)s
 """
 
+def _iter_command_nodes(node):
+    """
+    Iterate over the child nodes of a node.
+
+    For ``among`` the nodes of its commands are included.
+    """
+    for child in node:
+        yield child
+    if isinstance(node, AmongNode):
+        for command in node.commands + [node.common_cmd]:
+            if command:
+                yield command
+
+def _find_inline_routines(program):
+    """
+    Find the routines that can be inlined at their call site.
+
+    A routine is inlined if it is called from exactly one place, in the
+    same direction in which it is defined, and if it is neither an
+    external, nor used in an ``among``, nor (indirectly) recursive.
+
+    Returns a dict that maps the names of these routines to their
+    ``RoutineDefinitionNode``.
+    """
+    definitions = {}  # Name -> (node, direction)
+    calls = {}        # Name -> [(calling routine, direction)]
+    excluded = set()
+
+    def walk(node, routine, direction):
+        if isinstance(node, (BackwardModeNode, BackwardsNode)):
+            direction = -direction
+        elif isinstance(node, RoutineDefinitionNode):
+            definitions[node.name] = (node, direction)
+            routine = node.name
+        elif isinstance(node, RoutineCallNode):
+            calls.setdefault(node[0].name, []).append((routine, direction))
+        elif isinstance(node, ExternalDeclarationNode):
+            excluded.add(node.name)
+        elif isinstance(node, AmongNode):
+            excluded.update(string[1] for string in node.strings if string[1])
+        for child in _iter_command_nodes(node):
+            walk(child, routine, direction)
+
+    walk(program, None, 1)
+
+    callees = {}
+    for name, sites in calls.items():
+        for caller, direction in sites:
+            callees.setdefault(caller, set()).add(name)
+
+    def is_recursive(name):
+        stack = list(callees.get(name, ()))
+        seen = set()
+        while stack:
+            callee = stack.pop()
+            if callee == name:
+                return True
+            if callee not in seen:
+                seen.add(callee)
+                stack.extend(callees.get(callee, ()))
+        return False
+
+    inline = {}
+    for name, (node, direction) in definitions.items():
+        sites = calls.get(name, [])
+        if (len(sites) == 1 and sites[0][1] == direction and
+                name not in excluded and not is_recursive(name)):
+            inline[name] = node
+    return inline
+
 class ProgramNode(Node):
     """
     Root node representing a complete Snowball program.
     """
+    cacheable = False
+
     def generate_code(self, env):
+        # Routines that are only called once are inlined to save the
+        # function call overhead.
+        env.inline_routines = _find_inline_routines(self)
         self.generate_children_codes(env)
         if env.header:
             header = sbl2py.utils.prefix_lines(env.header, '# ')
@@ -1146,13 +1526,12 @@ class ProgramNode(Node):
         module_code = '\n'.join(env.module_code)
         init_code = sbl2py.utils.prefix_lines(
                 '\n'.join(env.init_code), '        ')
-        class_code = sbl2py.utils.prefix_lines(
-                '\n\n'.join(env.class_code), '    ')
+        routine_code = '\n\n\n'.join(env.routine_code)
         return _MODULE_TEMPLATE % {
             'header':header,
             'date':date,
             'version':version,
             'module_code':module_code,
             'init_code':init_code,
-            'class_code':class_code,
+            'routine_code':routine_code,
         }
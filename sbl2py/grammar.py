@@ -27,38 +27,104 @@
 Snowball grammar and parser for sbl2py.
 """
 
-import functools
-import inspect
+import os
+import re
 import sys
 import threading
+import warnings
 
 from pyparsing import *
 
 from sbl2py.ast import *
 
 
-__all__ = ['parse_string']
+__all__ = ['enable_packrat', 'parse_string']
 
 
 # Grammar elements are in all-caps.
 
 
-ParserElement.enablePackrat()
+def enable_packrat(size=None):
+    """
+    Enable packrat parsing.
+
+    The grammar rarely backtracks, so packrat parsing is disabled by
+    default since its bookkeeping makes parsing slower. ``size`` is the
+    maximum number of parse results that are cached, ``None`` means
+    unlimited.
+
+    Packrat parsing can also be enabled using the environment variable
+    ``SBL2PY_PACKRAT``, see ``_packrat_size``.
+
+    Note that packrat parsing cannot be disabled again once it has been
+    enabled.
+    """
+    ParserElement.enablePackrat(cache_size_limit=size)
+
+_DEFAULT_PACKRAT_SIZE = 128  # Same as pyparsing's default
+
+def _packrat_size(value):
+    """
+    Interpret the value of the ``SBL2PY_PACKRAT`` environment variable.
+
+    Returns ``False`` if packrat parsing should stay disabled and the
+    cache size for ``enable_packrat`` otherwise.
+
+    An empty value, ``0``, ``no``, ``off`` and ``false`` keep packrat
+    parsing disabled. ``1``, ``yes``, ``on`` and ``true`` enable it with
+    the default cache size (128 parse results) and ``none`` enables it
+    with an unlimited cache. Any other positive number is used as the
+    maximum number of cached parse results. Invalid values are ignored
+    with a warning.
+    """
+    value = value.strip().lower()
+    if value in ('', '0', 'no', 'off', 'false'):
+        return False
+    if value in ('1', 'yes', 'on', 'true'):
+        return _DEFAULT_PACKRAT_SIZE
+    if value == 'none':
+        return None
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if size > 0:
+        return size
+    warnings.warn('Ignoring invalid value %r of SBL2PY_PACKRAT.' % value)
+    return False
+
+_packrat = _packrat_size(os.environ.get('SBL2PY_PACKRAT', ''))
+if _packrat is not False:
+    enable_packrat(_packrat)
 
 
 #
 # PARSER STATE
 #
 
-state = threading.local()
-state.strings = []        # Declared string names
-state.integers = []       # Declared integer names
-state.externals = []      # Declared externals names
-state.booleans = []       # Declared boolean names
-state.routines = []       # Declared routine names
-state.groupings = []      # Declared grouping names
-state.stringescapes = []  # Left and right string escape chars
-state.stringdefs = {}     # String replacement definitions
+class _ParserState(object):
+    """
+    Internal parser state.
+
+    The grammar elements keep references to the containers of the
+    state, so these must be modified in place.
+    """
+
+    def __init__(self):
+        self.strings = []        # Declared string names
+        self.integers = []       # Declared integer names
+        self.externals = []      # Declared externals names
+        self.booleans = []       # Declared boolean names
+        self.routines = []       # Declared routine names
+        self.groupings = []      # Declared grouping names
+        self.stringescapes = []  # Left and right string escape chars
+        self.stringdefs = {}     # String replacement definitions
+
+state = _ParserState()
+
+# The grammar and its state are shared, so only one string can be
+# parsed at a time.
+_parse_lock = threading.Lock()
 
 def reset():
     """
@@ -72,6 +138,7 @@ def reset():
     state.groupings[:] = []
     state.stringescapes[:] = []
     state.stringdefs.clear()
+    update_references()
 
 
 #
@@ -93,33 +160,37 @@ def parse_action(f):
     actual ``TypeError`` bubbles up from the call to the parse action
     (instead of the one caused by pyparsing's trial & error).
     """
-    num_args = len(inspect.getargspec(f).args)
+    num_args = f.__code__.co_argcount
     if num_args > 3:
         raise ValueError('Input function must take at most 3 parameters.')
 
-    @functools.wraps(f)
+    # pyparsing passes ``(string, loc, tokens)``, ``f`` gets the last
+    # ``num_args`` of them in reverse order.
+    arg_slice = slice(None, -(num_args + 1), -1)
+
     def action(*args):
         if len(args) < num_args:
+            # pyparsing only retries with less arguments after a
+            # ``TypeError``, so ``exc_info`` doesn't need to be reset
+            # on successful calls.
             if action.exc_info:
-                raise (action.exc_info[0], action.exc_info[1],
-                       action.exc_info[2])
-        action.exc_info = None
+                exc_info = action.exc_info
+                action.exc_info = None
+                raise exc_info[0], exc_info[1], exc_info[2]
         try:
-            v = f(*args[:-(num_args + 1):-1])
-            return v
-        except TypeError as e:
+            return f(*args[arg_slice])
+        except TypeError:
             action.exc_info = sys.exc_info()
             raise
 
-    action.exc = None
+    action.__name__ = f.__name__  # Helps with debugging
+    action.exc_info = None
     return action
 
 
-def make_node_action(cls, ungroup=False, init_args=0):
+def make_node_action(cls, init_args=0):
     @parse_action
     def action(tokens):
-        if ungroup:
-            tokens = tokens[0]
         node = cls(*tokens[:init_args])
         node.extend(tokens[init_args:])
         return node
@@ -131,17 +202,17 @@ def add_node_action(pattern, *args, **kwargs):
     return pattern
 
 
-def make_binary_op_list_action(operators, classes, ungroup=False):
+def make_binary_op_list_action(operators, classes):
     """
     Make parse action for lists of binary operators and operands.
 
     ``operators`` is a list of the operators (as strings) and
     ``classes`` is a list of the corresponding ``Node`` subclasses.
+    The operators are left-associative. A single operand is returned
+    unchanged.
     """
     @parse_action
     def action(tokens):
-        if ungroup:
-            tokens = tokens[0]
         tokens = list(reversed(tokens))
         left = tokens.pop()
         while tokens:
@@ -153,7 +224,7 @@ def make_binary_op_list_action(operators, classes, ungroup=False):
             node.append(left)
             node.append(tokens.pop())
             left = node
-        return node
+        return left
 
     return action
 
@@ -172,13 +243,17 @@ def make_keyword(s):
     globals()[s.upper()] = kw
     keywords.append(kw)
 
-map(make_keyword, """maxint minint cursor limit size sizeof or and strings
+for name in """maxint minint cursor limit size sizeof or and strings
 integers booleans routines externals groupings define as not test try do fail
 goto gopast repeat loop atleast insert attach delete hop next setmark tomark
 atmark tolimit atlimit setlimit for backwards reverse substring among set unset
-non true false backwardmode stringescapes stringdef hex decimal""".split())
+non true false backwardmode stringescapes stringdef hex decimal""".split():
+    make_keyword(name)
 
-KEYWORD = MatchFirst(keywords)
+# A single regular expression is much faster than trying each keyword
+# in turn. Like ``Keyword`` it only matches whole words.
+KEYWORD = Regex(r'(?<![a-zA-Z0-9_$])(?:%s)(?![a-zA-Z0-9_$])' % '|'.join(
+        sorted((kw.match for kw in keywords), key=len, reverse=True)))
 
 
 #
@@ -193,16 +268,20 @@ NAME.setParseAction(parse_action(lambda t: t[0]))
 # DECLARATIONS
 #
 
+# Declaration actions by keyword, also used by ``prescan_declarations``
+declaration_actions = {}
+
 def make_decl(kw, targets, cls):
     declaration = Suppress(kw) + LPAREN + ZeroOrMore(NAME) + RPAREN
 
-    @parse_action
-    def action(tokens):
+    def declare(names):
         for target in targets:
-            target.extend(tokens)
-        return [cls(t) for t in tokens]
+            target.extend(names)
+        update_references()
+        return [cls(name) for name in names]
 
-    declaration.setParseAction(action)
+    declaration.setParseAction(parse_action(declare))
+    declaration_actions[kw.match] = declare
     return declaration
 
 DECLARATION = MatchFirst([
@@ -220,7 +299,17 @@ DECLARATION = MatchFirst([
 # REFERENCES
 #
 
-reference_chars = set(alphanums + '_')
+_reference_re = re.compile('[%s]+' % re.escape(alphanums + '_'))
+
+# All ``Reference`` instances, including copies made by pyparsing
+references = []
+
+def update_references():
+    """
+    Update all references after the declarations have been modified.
+    """
+    for reference in references:
+        reference.update()
 
 class Reference(Token):
     """
@@ -237,26 +326,39 @@ class Reference(Token):
 
         ``declarations`` is a list of previously declared variables.
         Any of them will match if they occur as a separate word (cf.
-        ``Keyword``). Matching is done in decreasing length of
-        candidates (cf. ``Or``). Later updates of ``declarations``
-        are taken into account.
+        ``Keyword``). ``update`` must be called after ``declarations``
+        has been modified.
         """
         super(Reference, self).__init__()
         self.declarations = declarations
+        self.update()
+        references.append(self)
 
     def __str__(self):
         return 'Reference(%s)' % self.declarations
 
+    def copy(self):
+        pattern = super(Reference, self).copy()
+        references.append(pattern)
+        return pattern
+
+    def update(self):
+        """
+        Update the candidates from ``declarations``.
+        """
+        self._names = frozenset(self.declarations)
+        self._error = "Expected one of " + ", ".join(
+            sorted(self.declarations, key=len, reverse=True))
+
     def parseImpl(self, instring, loc, doActions=True):
-        candidates = sorted(self.declarations, key=lambda x: len(x),
-                            reverse=True)
-        for candidate in candidates:
-            if instring.startswith(candidate, loc):
-                n = len(candidate)
-                if (len(instring) == loc + n or instring[loc + n] not in
-                        reference_chars):
-                    return loc + n, candidate
-        raise ParseException("Expected one of " + ", ".join(candidates))
+        # Declared names consist of reference characters only, so a
+        # separate word matches iff the whole word is a declared name.
+        m = _reference_re.match(instring, loc)
+        if m is not None:
+            word = m.group()
+            if word in self._names:
+                return m.end(), word
+        raise ParseException(self._error)
 
 
 def make_reference(declarations, cls):
@@ -296,6 +398,12 @@ class StringLiteral(Token):
         super(StringLiteral, self).__init__()
         self.escape_chars = escape_chars
         self.replacements = replacements
+        self._escapes = None     # Escape chars of the compiled regexes
+        self._escape_re = None   # Compiled regex for escape sequences
+        self._scan_re = None     # Compiled regex for quotes and escapes
+
+    def _replace_escape(self, match):
+        return self.replacements.get(match.group(1), match.group(0))
 
     def __str__(self):
         if self.escape_chars:
@@ -306,27 +414,48 @@ class StringLiteral(Token):
     def parseImpl(self, instring, loc, doActions=True):
         if instring[loc] != "'":
             raise ParseException('Expected "\'".')
-        # Find next "'" that is not contained in escape chars
-        pos = loc + 1
-        while True:
+        if not self.escape_chars:
             try:
-                candidate = instring.index("'", pos)
+                candidate = instring.index("'", loc + 1)
             except ValueError:
                 raise ParseException('Runaway string literal.')
-            if not self.escape_chars:
-                break
-            left = instring.rfind(self.escape_chars[0], loc, candidate)
-            right = instring.rfind(self.escape_chars[1], loc, candidate)
-            if right >= left:
+            return candidate + 1, unicode(instring[loc + 1 : candidate])
+
+        # Most literals contain no escape sequences, these need neither
+        # the scan nor the replacement below.
+        candidate = instring.find("'", loc + 1)
+        if (candidate != -1 and
+                instring.find(self.escape_chars[0], loc + 1, candidate) == -1):
+            return candidate + 1, unicode(instring[loc + 1 : candidate])
+
+        # The regexes only depend on the escape chars and are recompiled
+        # when these change.
+        escapes = tuple(self.escape_chars)
+        if escapes != self._escapes:
+            left = re.escape(escapes[0])
+            right = re.escape(escapes[1])
+            self._escape_re = re.compile(left + '([^' + left + ']*?)' + right)
+            self._scan_re = re.compile("['" + left + right + "]")
+            self._escapes = escapes
+
+        # Find next "'" that is not contained in escape chars using a
+        # single forward scan.
+        inside = False
+        for match in self._scan_re.finditer(instring, loc + 1):
+            c = match.group()
+            if c == escapes[1]:
+                inside = False
+            elif c == escapes[0]:
+                inside = True
+            elif not inside:
+                candidate = match.start()
                 break
-            pos = candidate + 1
-        s = instring[loc + 1 : candidate]
-        if self.escape_chars:
-            # Replace escape sequences
-            left = re.escape(self.escape_chars[0])
-            right = re.escape(self.escape_chars[1])
-            for k, v in self.replacements.iteritems():
-                s = re.sub(left + re.escape(k) + right, v, s)
+        else:
+            raise ParseException('Runaway string literal.')
+
+        # Replace escape sequences
+        s = self._escape_re.sub(self._replace_escape,
+                                instring[loc + 1 : candidate])
         return candidate + 1, unicode(s)
 
 
@@ -343,10 +472,13 @@ def stringdef_cmd_action(tokens):
     key = tokens[0]
     mode = tokens[1]
     value = tokens[2].string
+    # Each space-separated number is a single code point, which may be
+    # larger than 0xFF (e.g. Cyrillic), so ``str.decode('hex')`` cannot
+    # be used here.
     if mode == 'hex':
-        value = u''.join(unichr(int(x, 16)) for x in value.split())
+        value = u''.join([unichr(int(x, 16)) for x in value.split()])
     elif mode == 'decimal':
-        value = u''.join(unichr(int(x)) for x in value.split())
+        value = u''.join([unichr(int(x)) for x in value.split()])
     state.stringdefs[key] = value
     return []
 
@@ -393,20 +525,26 @@ EXPRESSION_OPERAND = MatchFirst([
     INT,
 ])
 
-negation_action =  make_node_action(NegationNode, ungroup=True)
 multiplicative_action = make_binary_op_list_action(
         ['*', '/'], [MultiplicationNode, DivisionNode])
 additive_action = make_binary_op_list_action(
         ['+', '-'], [AdditionNode, SubtractionNode])
 
-EXPRESSION = operatorPrecedence(
-    EXPRESSION_OPERAND,
-    [
-        (Suppress('-'), 1, opAssoc.RIGHT,negation_action),
-        (oneOf('* /'), 2, opAssoc.LEFT, multiplicative_action),
-        (oneOf('+ -'), 2, opAssoc.LEFT, additive_action),
-    ]
-)
+# The precedence levels are spelled out instead of using pyparsing's
+# ``operatorPrecedence``, which looks ahead on every level and is
+# therefore much slower.
+EXPRESSION = Forward()
+EXPRESSION_ATOM = EXPRESSION_OPERAND | (LPAREN + EXPRESSION + RPAREN)
+EXPRESSION_NEGATION = Forward()
+EXPRESSION_NEGATION << (
+        add_node_action(Suppress('-') + EXPRESSION_NEGATION, NegationNode) |
+        EXPRESSION_ATOM)
+EXPRESSION_PRODUCT = (EXPRESSION_NEGATION +
+                      ZeroOrMore(oneOf('* /') + EXPRESSION_NEGATION))
+EXPRESSION_PRODUCT.setParseAction(multiplicative_action)
+EXPRESSION << (EXPRESSION_PRODUCT +
+               ZeroOrMore(oneOf('+ -') + EXPRESSION_PRODUCT))
+EXPRESSION.setParseAction(additive_action)
 
 
 #
@@ -473,7 +611,7 @@ unary_actions = {
 
 @parse_action
 def unary_action(tokens):
-    return unary_actions[tokens[0][0]](tokens[0][1:])
+    return unary_actions[tokens[0]](tokens[1:])
 
 CMD_INSERT = add_node_action(Suppress(INSERT | '<+') + CHARS, InsertNode)
 CMD_ATTACH = add_node_action(Suppress(ATTACH) + CHARS, AttachNode)
@@ -513,7 +651,7 @@ def cmd_among_action(tokens):
             string = element[0].string
             routine = element[1].name if element[1] else ''
             strings.append((string, routine, index))
-    strings.sort(cmp=lambda x, y: len(y[0]) - len(x[0])) # by decreasing length
+    strings.sort(key=lambda t: -len(t[0])) # by decreasing length
     commands = [arg[1] for arg in tokens]
     return AmongNode(strings, commands, common_cmd=common_cmd)
 
@@ -532,18 +670,27 @@ STR_CMD_OPERAND = (INT_CMD | CMD_STARTSWITH | CMD_SETLIMIT | CMD_INSERT |
                    CMD_SUBSTRING | CMD_AMONG | CMD_ROUTINE | CMD_GROUPING |
                    CMD_NON | CMD_TRUE | CMD_FALSE | CMD_BOOLEAN)
 
-concatenation_action = make_node_action(ConcatenationNode, ungroup=True)
-and_or_action = make_binary_op_list_action(
-        ['and', 'or'], [AndNode, OrNode], ungroup=True)
+@parse_action
+def concatenation_action(tokens):
+    if len(tokens) == 1:
+        return tokens[0]
+    node = ConcatenationNode()
+    node.extend(tokens)
+    return node
+
+and_or_action = make_binary_op_list_action(['and', 'or'], [AndNode, OrNode])
 
-STR_CMD << operatorPrecedence(
-    STR_CMD_OPERAND,
-    [
-        (UNARY_OPERATOR, 1, opAssoc.RIGHT, unary_action),
-        (AND | OR, 2, opAssoc.LEFT, and_or_action),
-        (Empty(), 2, opAssoc.LEFT, concatenation_action),
-    ]
-)
+# Precedence levels from highest to lowest: unary operators, ``and`` and
+# ``or``, concatenation. See ``EXPRESSION`` above.
+STR_CMD_ATOM = STR_CMD_OPERAND | (LPAREN + STR_CMD + RPAREN)
+STR_CMD_UNARY = Forward()
+STR_CMD_UNARY << (
+        (UNARY_OPERATOR + STR_CMD_UNARY).setParseAction(unary_action) |
+        STR_CMD_ATOM)
+STR_CMD_AND_OR = STR_CMD_UNARY + ZeroOrMore((AND | OR) + STR_CMD_UNARY)
+STR_CMD_AND_OR.setParseAction(and_or_action)
+STR_CMD << OneOrMore(STR_CMD_AND_OR)
+STR_CMD.setParseAction(concatenation_action)
 
 
 #
@@ -607,6 +754,45 @@ PROGRAM = add_node_action(
 PROGRAM.ignore(cStyleComment | dblSlashComment)
 
 
+#
+# DECLARATION PRESCAN
+#
+
+_SKIP_RE = re.compile(r'(?:\s+|/\*.*?\*/|//[^\n]*)*', re.DOTALL)
+_DECLARATION_RE = re.compile(
+        r'(strings|integers|booleans|routines|externals|groupings)' +
+        r'\s*\(([\s\w]*)\)')
+_NAME_RE = re.compile(r'[a-zA-Z]\w*$')
+_keyword_strings = set(kw.match for kw in keywords)
+
+def prescan_declarations(s):
+    """
+    Process the declarations at the beginning of Snowball code.
+
+    Most Snowball programs start with a block of simple declarations
+    which are handled here using regular expressions instead of the
+    considerably slower pyparsing grammar. Scanning stops at the first
+    code that is not such a declaration (or a comment).
+
+    Returns a list of the declaration nodes and the position up to
+    which ``s`` has been processed.
+    """
+    nodes = []
+    pos = 0
+    while True:
+        start = _SKIP_RE.match(s, pos).end()
+        match = _DECLARATION_RE.match(s, start)
+        if not match:
+            break
+        names = match.group(2).split()
+        if not all(_NAME_RE.match(name) and name not in _keyword_strings
+                   for name in names):
+            break
+        nodes.extend(declaration_actions[match.group(1)](names))
+        pos = match.end()
+    return nodes, pos
+
+
 #
 # PUBLIC INTERFACE
 #
@@ -617,5 +803,12 @@ def parse_string(s):
 
     Returns the corresponding AST.
     """
-    reset()
-    return PROGRAM.parseString(s)[0]
+    with _parse_lock:
+        reset()
+        nodes, pos = prescan_declarations(s)
+        # Blank out the processed part to keep error locations intact
+        s = re.sub(r'[^\n]', ' ', s[:pos]) + s[pos:]
+        program = PROGRAM.parseString(s)[0]
+    for index, node in enumerate(nodes):
+        program.insert(index, node)
+    return program
@@ -27,29 +27,30 @@
 Various utilities.
 """
 
-import imp
 import itertools
-import math
 import re
+import types
+
+
+# Compiled code objects of ``module_from_code``, keyed by source code
+_code_cache = {}
+_code_cache_size = 32
+
+# Encoding declaration in Python source code (PEP 263)
+_coding_re = re.compile(r"coding[:=]\s*([-\w.]+)")
 
 
 def remove_empty_lines(s):
     """
     Remove empty lines from a string.
     """
-    return '\n'.join(line for line in s.splitlines() if line)
+    return '\n'.join([line for line in s.splitlines() if line])
 
 def prefix_lines(s, p):
     """
     Prefix each line of ``s`` by ``p``.
     """
-    try:
-        return p + ('\n' + p).join(s.splitlines())
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        import pdb; pdb.set_trace()
-        raise
+    return p + s.replace('\n', '\n' + p)
 
 def extract(seq, f):
     """
@@ -59,22 +60,48 @@ def extract(seq, f):
     callback ``f`` returns ``True`` are returned in a list.
     """
     try:
-        it = iter(seq)
+        stack = [iter(seq)]
     except TypeError:
         return []
     items = []
-    for item in it:
-        if f(item):
-            items.append(item)
+    # Depth-first traversal using a stack of iterators instead of
+    # recursion, which keeps the items in order.
+    while stack:
+        for item in stack[-1]:
+            if f(item):
+                items.append(item)
+            else:
+                try:
+                    stack.append(iter(item))
+                except TypeError:
+                    continue
+                break
         else:
-            items.extend(extract(item, f))
+            stack.pop()
     return items
 
 def extract_strings(seq):
     """
     Extract all strings from a possibly nested sequence.
     """
-    return extract(seq, lambda x: isinstance(x, basestring))
+    # Same as ``extract(seq, lambda x: isinstance(x, basestring))`` but
+    # without a callback per item since this is called for most nodes
+    # during code generation.
+    try:
+        stack = [iter(seq)]
+    except TypeError:
+        return []
+    strings = []
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, basestring):
+                strings.append(item)
+            elif hasattr(item, '__iter__'):
+                stack.append(iter(item))
+                break
+        else:
+            stack.pop()
+    return strings
 
 def annotate(text, caption, prefix='', single='> ', first='\\ ', middle=' | ',
              last='/ '):
@@ -92,20 +119,15 @@ def annotate(text, caption, prefix='', single='> ', first='\\ ', middle=' | ',
     last one with ``last``.
     """
     lines = text.splitlines()
-    lengths = [len(line) for line in lines]
-    c = max(lengths)
     n = len(lines)
-    for i in range(n):
-        if n == 1:
-            s = single
-        elif i == 0:
-            s = first
-        elif i == n - 1:
-            s = last
-        else:
-            s = middle
-        lines[i] = lines[i] + ' ' * (c - lengths[i]) + prefix + s
-    lines[n / 2] += caption
+    if n == 1:
+        markers = [single]
+    else:
+        markers = [first] + [middle] * (n - 2) + [last]
+    c = max(len(line) for line in lines)
+    lines = [line.ljust(c) + prefix + marker
+             for line, marker in zip(lines, markers)]
+    lines[n // 2] += caption
     return '\n'.join(lines)
 
 def group(iterable, size):
@@ -122,24 +144,34 @@ def add_line_numbers(text, margin="  "):
     Add line numbers to a text.
     """
     lines = text.splitlines()
-    num_digits = math.floor(math.log10(len(lines))) + 1
-    format_str = '%%%dd%s%%s' % (num_digits, margin)
-    nums = xrange(1, len(lines) + 1)
-    return '\n'.join(format_str % (n, line) for (n, line) in zip(nums, lines))
+    format_str = '%%%dd%s%%s' % (len(str(len(lines))), margin)
+    return '\n'.join([format_str % (n, line) for n, line in
+                      enumerate(lines, 1)])
 
 def module_from_code(name, code):
     """
     Dynamically create Python module from code string.
+
+    The code is compiled only once, creating further modules from the
+    same code reuses the compiled code object.
     """
     if isinstance(code, unicode):
-        # Remove encoding declaration if present
-        lines = code.splitlines()
-        for i in (0, 1):
-            if re.search(r"coding[:=]\s*([-\w.]+)", lines[i]) is not None:
+        # Remove encoding declaration if present. It can only occur in
+        # the first two lines, so the rest of the code is not split.
+        lines = code.split('\n', 2)
+        for i, line in enumerate(lines[:2]):
+            if 'coding' in line and _coding_re.search(line) is not None:
                 lines[i] = ''
+                code = '\n'.join(lines)
                 break
-        code = '\n'.join(lines)
 
-    module = imp.new_module(name)
-    exec code in module.__dict__
+    try:
+        compiled = _code_cache[code]
+    except KeyError:
+        if len(_code_cache) >= _code_cache_size:
+            _code_cache.clear()
+        compiled = _code_cache[code] = compile(code, '<string>', 'exec')
+
+    module = types.ModuleType(name)
+    exec compiled in module.__dict__
     return module
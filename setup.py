@@ -41,7 +41,7 @@ setup(
     ],
     keywords='snowball compiler',
     packages=find_packages(exclude='test'),
-    install_requires=['pyparsing >= 2.0'],
+    install_requires=['pyparsing >= 2.1.6'],
     platforms=['any'],
     entry_points={'console_scripts':['sbl2py=sbl2py.__main__:main']},
 )
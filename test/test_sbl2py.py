@@ -31,15 +31,27 @@ Tests for ``sbl2py``.
 
 import codecs
 import glob
+import itertools
+import multiprocessing
 import os.path
-import unittest
+import subprocess
 import sys
+import threading
+import traceback
+import warnings
 
 from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+from pyparsing import ParseBaseException
 
 _module_dir = os.path.dirname(__file__)
 sys.path.append(os.path.abspath(os.path.join(_module_dir, '..', 'src')))
 import sbl2py
+from sbl2py.ast import (ExternalDeclarationNode, IntegerDeclarationNode,
+                        RoutineDeclarationNode, RoutineDefinitionNode,
+                        StringDeclarationNode)
+from sbl2py.grammar import (_packrat_size, parse_action, parse_string,
+                            prescan_declarations)
 from sbl2py.utils import add_line_numbers, module_from_code
 
 
@@ -47,6 +59,10 @@ from sbl2py.utils import add_line_numbers, module_from_code
 # TESTS FOR INDIVIDUAL SNOWBALL FEATURES                              #
 #######################################################################
 
+# Generated Python code and modules of ``assert_snowball``, keyed by the
+# Snowball code they were created from.
+_test_modules = {}
+
 def assert_snowball(code, tests, routine='check'):
     """
     Test that compiling and executing a piece of Snowball code works.
@@ -58,25 +74,31 @@ def assert_snowball(code, tests, routine='check'):
     which contains at least the test input and expected output. The
     test case may also contain dicts of expected attribute values for
     the attributes of the ``_String`` and ``_Program`` instances.
+
+    Identical Snowball code is only translated once.
     """
     code = ("externals (%s)\n" % routine) + code
 
-    try:
-        pycode = sbl2py.translate_string(code, debug=True)
-    except Exception as e:
-        print ("Could not translate the following Snowball code:\n\n" +
-                add_line_numbers(code))
-        raise
-
     def msg(s):
         return (s + "\n\nSnowball code:\n\n" + add_line_numbers(code) +
                 "\n\nPython code:\n\n" + add_line_numbers(pycode))
 
     try:
-        module = module_from_code('sbl2py_testmodule', pycode)
-    except SyntaxError as e:
-        print msg("Generated code is invalid: %s" % e)
-        raise
+        pycode, module = _test_modules[code]
+    except KeyError:
+        try:
+            pycode = sbl2py.translate_string(code, debug=True)
+        except Exception as e:
+            print ("Could not translate the following Snowball code:\n\n" +
+                    add_line_numbers(code))
+            raise
+
+        try:
+            module = module_from_code('sbl2py_testmodule', pycode)
+        except SyntaxError as e:
+            print msg("Generated code is invalid: %s" % e)
+            raise
+        _test_modules[code] = pycode, module
 
     fun = getattr(module, routine)
 
@@ -98,13 +120,13 @@ def assert_snowball(code, tests, routine='check'):
         for attr, exp_value in s_attrs.iteritems():
             value = getattr(output, attr)
             assert value == exp_value, msg(
-                    "Wrong value for string attribute '%s': Expected '%s', " +
+                    "Wrong value for string attribute '%s': Expected '%s', "
                     "got '%s'. Input was '%s', output was '%s'." %
                     (attr, exp_value, value, string, unicode(output)))
         for attr, exp_value in p_attrs.iteritems():
             value = getattr(program, attr)
             assert value == exp_value, msg(
-                    "Wrong value for program attribute '%s': Expected '%s', " +
+                    "Wrong value for program attribute '%s': Expected '%s', "
                     "got '%s'. Input was '%s', output was '%s'." %
                     (attr, exp_value, value, string, unicode(output)))
 
@@ -638,6 +660,20 @@ def test_routine_call():
             ('bar', 'bar'),
         )
     )
+    # External functions must not shadow the functions of routines
+    assert_snowball(
+        """
+        externals (r_foo)
+        routines (foo)
+        define foo as (['a'] <- 'b')
+        define r_foo as foo
+        define check as (foo or true)
+        """,
+        (
+            ('ab', 'bb'),
+            ('cb', 'cb'),
+        )
+    )
 
 def test_grouping_check():
     assert_snowball(
@@ -864,6 +900,39 @@ def test_int_cmds():
         )
     )
 
+def test_arithmetic_expressions():
+    assert_snowball(
+        """
+        integers (i j k)
+        define check as (
+          $i = 2 + 3 * 4 - 1
+          $j = (2 + 3) * 4 / 2
+          $k = 10 - 2 - -3
+          <+ 'x'
+        )
+        """,
+        (
+            ('', 'x', {}, {'i_i':13, 'i_j':10, 'i_k':11}),
+        )
+    )
+    # Bracketed right operands of ``*`` and ``/``
+    assert_snowball(
+        """
+        integers (a b c d e)
+        define check as (
+          $a = 8 / (4 / 2)
+          $b = 2 * (3 / 2)
+          $c = 8 / (2 * 2)
+          $d = 2 * (5 / 2)
+          $e = 8 / 4 / 2
+          <+ 'x'
+        )
+        """,
+        (
+            ('', 'x', {}, {'i_a':4, 'i_b':2, 'i_c':2, 'i_d':4, 'i_e':1}),
+        )
+    )
+
 def test_bool_cmds():
     assert_snowball(
         """
@@ -894,6 +963,181 @@ def test_stringdefs():
             ('a', 'a', {'cursor':0}),
         )
     )
+    # Backslashes in replacements must be inserted literally
+    assert_snowball(
+        r"""
+        stringescapes {}
+        stringdef bs '\1'
+        define check as (['x'] <- '{bs}')
+        """,
+        (
+            ('x', u'\\1'),
+            ('y', 'y'),
+        )
+    )
+
+
+#######################################################################
+# TESTS FOR INTERNALS                                                 #
+#######################################################################
+
+def test_assert_snowball_attribute_messages():
+    code = """
+        booleans ( found )
+        define check as ( 'foo' set found )
+        """
+    with assert_raises(AssertionError) as cm:
+        assert_snowball(code, (('foo', 'foo', {'cursor':5}),))
+    assert str(cm.exception).startswith("Wrong value for string attribute " +
+            "'cursor': Expected '5', got '3'. Input was 'foo', output was " +
+            "'foo'.\n"), str(cm.exception)
+    with assert_raises(AssertionError) as cm:
+        assert_snowball(code, (('foo', 'foo', {}, {'b_found':False}),))
+    assert str(cm.exception).startswith("Wrong value for program " +
+            "attribute 'b_found': Expected 'False', got 'True'. Input was " +
+            "'foo', output was 'foo'.\n"), str(cm.exception)
+
+
+def test_packrat_size():
+    for value in ['', '0', 'no', 'Off', ' false ']:
+        assert _packrat_size(value) is False, value
+    for value in ['1', 'yes', 'ON', 'true']:
+        assert _packrat_size(value) == 128, value
+    assert _packrat_size('none') is None
+    assert _packrat_size('500') == 500
+    for value in ['garbage', '-3', '1.5']:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            assert _packrat_size(value) is False, value
+        assert len(caught) == 1, value
+
+
+def test_parse_action_retry():
+
+    def fail(tokens):
+        raise TypeError('Original error')
+
+    # pyparsing retries with less arguments after a ``TypeError``
+    action = parse_action(fail)
+    with assert_raises(TypeError) as cm:
+        action()
+    assert not isinstance(cm.exception, AttributeError)
+    with assert_raises(TypeError) as cm:
+        action('string', 0, [])
+    assert str(cm.exception) == 'Original error'
+    with assert_raises(TypeError) as cm:
+        action([])
+    assert str(cm.exception) == 'Original error'
+    with assert_raises(TypeError) as cm:
+        action()
+    assert str(cm.exception) == 'Original error'
+
+
+def test_parse_action_traceback():
+
+    def fail(tokens):
+        raise TypeError('Original error')
+
+    # The re-raised error must keep the traceback of the original one
+    action = parse_action(fail)
+    with assert_raises(TypeError):
+        action('string', 0, [])
+    try:
+        action()
+    except TypeError:
+        frames = traceback.extract_tb(sys.exc_info()[2])
+    assert frames[-1][2] == 'fail', frames
+
+
+def test_parse_string_threads():
+    # Each thread parses programs with its own declarations. These must
+    # neither be missing nor leak into the programs of other threads.
+    errors = []
+    names = {}
+
+    def parse(i):
+        code = ('externals (e%d) routines (r%d) define e%d as r%d ' +
+                'define r%d as true') % ((i,) * 5)
+        try:
+            for _ in range(20):
+                program = parse_string(code)
+                for node in program:
+                    if isinstance(node, (ExternalDeclarationNode,
+                                         RoutineDefinitionNode)):
+                        names.setdefault(i, set()).add(node.name)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=parse, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+    for i in range(8):
+        assert names[i] == set(['e%d' % i, 'r%d' % i]), names[i]
+
+
+def test_error_location_after_declarations():
+    # The prescanned declarations are blanked out before parsing, error
+    # locations must still refer to the original code.
+    code = """strings ( a b )
+routines ( foo bar )
+define foo as 'x'
+  define bar as ( foo
+"""
+    with assert_raises(ParseBaseException) as cm:
+        parse_string(code)
+    assert (cm.exception.lineno, cm.exception.col) == (4, 3), cm.exception
+
+
+def test_prescan_stops_at_keyword():
+    code = "strings ( a ) routines ( foo ) define foo as true integers ( i )"
+    nodes, pos = prescan_declarations(code)
+    assert len(nodes) == 2, nodes
+    assert code[pos:].lstrip().startswith('define'), code[pos:]
+    # Keywords are not valid names, so such a declaration is left to
+    # the grammar.
+    nodes, pos = prescan_declarations("routines ( define )")
+    assert (nodes, pos) == ([], 0)
+    # Declarations after the first keyword are handled by the grammar
+    program = parse_string(code)
+    assert [node.__class__ for node in program] == [StringDeclarationNode,
+            RoutineDeclarationNode, RoutineDefinitionNode,
+            IntegerDeclarationNode]
+
+
+def test_translation_cache_default():
+    # The cache is disabled unless ``SBL2PY_CACHE`` is set to ``1``
+    env = dict(os.environ)
+    env.pop('SBL2PY_CACHE', None)
+    env['PYTHONPATH'] = os.path.abspath(os.path.join(_module_dir, '..'))
+    output = subprocess.check_output([sys.executable, '-c',
+            'import sbl2py; print sbl2py._use_translation_cache'], env=env)
+    assert output.strip() == 'False', output
+
+
+def test_translation_cache():
+    code = "externals ( check ) define check as 'foo'"
+    old_use_cache = sbl2py._use_translation_cache
+    sbl2py.clear_cache()
+    try:
+        sbl2py._use_translation_cache = False
+        first = sbl2py.translate_string(code)
+        assert sbl2py.translate_string(code) is not first
+        assert not sbl2py._translation_cache
+
+        sbl2py._use_translation_cache = True
+        first = sbl2py.translate_string(code)
+        assert sbl2py.translate_string(code) is first
+        assert sbl2py.translate_string(code, debug=True) is not first
+
+        sbl2py.clear_cache()
+        assert not sbl2py._translation_cache
+        assert sbl2py.translate_string(code) is not first
+    finally:
+        sbl2py._use_translation_cache = old_use_cache
+        sbl2py.clear_cache()
 
 
 #######################################################################
@@ -911,27 +1155,46 @@ def check_with_files(source_filename, input_filename, output_filename,
     py_code = sbl2py.translate_string(sbl_code)
     module = module_from_code('sbl2py_test_module', py_code)
     r = getattr(module, routine)
-    with codecs.open(input_filename, 'r', 'utf8') as f:
-        inputs = f.read().splitlines()
-    with codecs.open(output_filename, 'r', 'utf8') as f:
-        expected = f.read().splitlines()
-    for lineno, (inp, exp) in enumerate(zip(inputs, expected), 1):
-        try:
-            outp = r(inp)
-        except Exception as e:
-            print "Could not transform %s (line %d): %s" % (repr(inp), lineno,
-                                                            e)
-            raise
-        assert outp == exp, ('Wrong output for "%s" (line %d): Expected ' +
-                             '"%s", got "%s".' % (inp, lineno, exp, outp))
+    # The files are read line by line, so large word lists are never
+    # held in memory completely.
+    with codecs.open(input_filename, 'r', 'utf8') as inputs, \
+            codecs.open(output_filename, 'r', 'utf8') as expected:
+        for lineno, (inp, exp) in enumerate(itertools.izip(inputs, expected),
+                                            1):
+            # Strip line boundaries exactly like ``unicode.splitlines``
+            inp = inp.splitlines()[0] if inp else inp
+            exp = exp.splitlines()[0] if exp else exp
+            try:
+                outp = r(inp)
+            except Exception as e:
+                print "Could not transform %s (line %d): %s" % (repr(inp),
+                                                                lineno, e)
+                raise
+            assert outp == exp, ('Wrong output for "%s" (line %d): Expected '
+                                 '"%s", got "%s".' % (inp, lineno, exp, outp))
 
 
+# Maximum time in seconds to wait for the check of a single stemmer
+_STEMMER_TIMEOUT = 600
+
 @attr('slow')
 def test_stemmers():
     filenames = glob.glob(os.path.join(_module_dir, '*.sbl'))
-    for filename in filenames:
-        base = os.path.splitext(filename)[0]
-        test = lambda: check_with_files(filename, base + '_in.txt',
-                                        base + '_out.txt')
-        test.description = os.path.basename(filename)
-        yield test
+    # The stemmers are independent of each other, so they are all
+    # checked in parallel right away. Each test then waits for the
+    # result of its stemmer.
+    pool = multiprocessing.Pool()
+    try:
+        results = []
+        for filename in filenames:
+            base = os.path.splitext(filename)[0]
+            args = (filename, base + '_in.txt', base + '_out.txt')
+            results.append(pool.apply_async(check_with_files, args))
+        for filename, result in zip(filenames, results):
+            # Waiting with a timeout keeps the test run interruptible
+            # and makes sure that a hanging worker cannot stall it.
+            test = lambda result=result: result.get(_STEMMER_TIMEOUT)
+            test.description = os.path.basename(filename)
+            yield test
+    finally:
+        pool.terminate()